@@ -1,449 +1,1088 @@
-import os
-import re
-from flask import Flask, request, jsonify, send_file
-from flask_cors import CORS
-from openai import OpenAI
-from PyPDF2 import PdfReader
-from docx import Document
-from docx.shared import Inches, Pt, Cm
-from docx.enum.section import WD_ORIENT
-from docx.oxml import parse_xml
-from docx.oxml.ns import nsdecls
-from docx.shared import RGBColor
-import tempfile
-from datetime import datetime
-
-
-app = Flask(__name__)
-
-# ✅ Enable CORS globally
-CORS(app, supports_credentials=True)
-
-@app.after_request
-def after_request(response):
-    """Ensure every response includes proper CORS headers."""
-    response.headers["Access-Control-Allow-Origin"] = "*"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
-    response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
-    response.headers["Access-Control-Allow-Credentials"] = "true"
-    return response
-
-
-# ✅ Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-# ------------------------------------------------------------
-# BASIC ROUTES
-# ------------------------------------------------------------
-@app.route("/", methods=["GET"])
-def home():
-    return jsonify({"message": "Lesson Planner API is running"}), 200
-
-# ✅ Handle preflight (CORS) for /generate route
-@app.route("/generate", methods=["OPTIONS"])
-def generate_options():
-    """Handle CORS preflight for the /generate route."""
-    response = jsonify({"ok": True})
-    response.headers["Access-Control-Allow-Origin"] = "*"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
-    response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
-    return response, 200
-
-# ------------------------------------------------------------
-# SYSTEM PROMPT — EXACT TEXT AND NO ASTERISKS
-# ------------------------------------------------------------
-SYSTEM_PROMPT = """
-You are an expert English Language Teaching (ELT) mentor and instructional designer
-operating within the BAE Systems KSA Training Standards (StanEval Form 0098).
-
-Your purpose is to generate complete, professional, observation-ready English lesson plans
-and mentoring guidance that fully meet the standards for Good and Outstanding
-teaching performance in accordance with the official BAE StanEval rubric.
-
-Important style rules
-- Plain text only; no markdown or code blocks.
-- Never output asterisks at all. Do not output * or ** anywhere.
-- Use formal, readable English suitable for observation reports.
-- Write headings as plain words only; do not surround with symbols.
-- Include blank lines between sections for clarity.
-- Make the output export-ready for DOCX in landscape orientation.
-
-Context and role
-- Your audience is BAE Systems instructors and cadet-class teachers in KSA.
-- Your tone must be professional, supportive, and rubric-aligned.
-- You prepare teachers for real formal observations; your lesson plans must show clear evidence of meeting each StanEval domain.
-
-Rubric domains and exact performance descriptors
-Use the following descriptors verbatim whenever you reference or check against the rubric. Do not paraphrase or invent new wording. Only the Good and Outstanding levels are permitted.
-
-1) Lesson Plan
-Outstanding: Highly detailed, including full explanation of timed stages, structure, method and interaction patterns. Excellent range of activities planned. Clearly identifies resources to meet learning needs.
-Good: Good, clear structure which identifies resources, and activities linked to learning needs. May lack detail but nevertheless maps defined stages progressively, with approximate timings, throughout the lesson.
-
-2) Introduction, Aims and Objectives
-Outstanding: Comprehensive introduction. Aims and objectives are fully explained, shared and displayed. Learners are able to demonstrate clear understanding of the lesson’s purpose.
-Good: Detailed introduction in which aims and objectives are shared with learners at beginning or as the lesson unfolds. Further explanation of objectives provided. Learners clear about learning purpose.
-
-3) Student and Classroom Management
-Outstanding: Takes responsibility for and has the knowledge to promote and manage behaviour effectively. Actively encourages learners to behave well; manages a high level of motivation. Professional learning environment, fully compliant with Standard Operating Procedures (SOP-4) and mandated classroom protocols.
-Good: Sets, manages and enforces clear rules and routines. Demonstrates a positive relationship with all learners. Exercises authority appropriately. May raise minor concerns. Fit for purpose, well laid out, accessible and safely equipped.
-
-4) Training and Teaching Aids and Resources
-Outstanding: Variety of training/teaching aids used to enhance learning objectives. Training/teaching aids sourced beyond the classroom environment and authorised for use to support continuous improvement. Aids and resources fully integrated into the lesson delivery.
-Good: Training/teaching aids and resources are well-prepared. Usage enhances understanding/delivery of the lesson and assists in achieving the lesson objectives.
-
-5) Communication Skills
-Outstanding: Outstanding presentation skills which engage learners and promote high levels of sustained motivation and concentration. Positive verbal and non-verbal communication, such as strong voice, fluent speech patterns, clear eye contact, enthusiastic manner and open body language/expression.
-Good: Delivery shows a good level of commitment and energy and holds learner’s interest. Good presentation skills which promote motivation and concentration. Teacher demonstrates effective verbal/non-verbal communication skills.
-
-6) Variety and Effectiveness of Interaction
-Outstanding: Wide variety of interaction in the classroom that includes pair and group work. The lesson contains many planned stages of learner-centred activity with the teacher playing a facilitator role. All interaction with learners is effective, has a clear purpose and is handled well.
-Good: Good variety of interaction in the classroom that includes pair and group work. The lesson contains some planned stages of learner-centred activity with the teacher playing a facilitator role. Most of the interaction attempted with learners is effective, has a clear purpose and is handled well.
-
-7) Question and Answer Techniques
-Outstanding: Wide range of questions used. Questions challenge and stimulate learning, encouraging learners to pose questions and responses where appropriate. Checking of understanding is present throughout, enabling continuous assessment of student learning.
-Good: Variety of questioning techniques used effectively, not limited to pose-pause-pounce but includes other techniques such as open and closed questions. Student responses are well managed and encourage further questioning.
-
-8) Check of Learning and Summary
-Outstanding: Comprehensive review of learning progress throughout lesson and clear summary linked to learning aims/objectives. Check for learning is continuous and thorough.
-Good: Clear, concise review/recap at points in the lesson and clear summary of learning progress at end of lesson with links to lesson aims/objectives.
-
-9) Practical Activity — Safety
-Outstanding: A comprehensive safety introduction brief, relevant to task and working environment. Learners are able to demonstrate clear understanding of all safety aspects. Comprehensive explanation of PPE given and supplied where required. Risk assessment available.
-Good: Detailed safety introduction brief, relevant to task and working environment. Learners clear on all safety aspects. PPE explained and supplied where required and further explanation of reason for their use. Risk assessment available.
-
-10) Practical Activity — Explanation of Task
-Outstanding: Comprehensive explanation of task. Learning aims of the task are fully explained and shared. Learners are able to demonstrate clear understanding of what they will be doing and how.
-Good: Detailed explanation of task. Learning aims of the task are detailed in logical steps with the learners clear about what they will be doing and how.
-
-11) Practical Activity — Engagement and Inclusion of Task
-Outstanding: Outstanding level of encouragement given from teacher/instructor, ensuring a high level of engagement and inclusion with the task from learners. All cadets fully engaged; positive learning taking place.
-Good: Good level of encouragement given from teacher/instructor, ensuring a consistent level of engagement and inclusion with the task from learners. All cadets fully engaged; positive learning taking place.
-
-Generation logic
-When Target Rating is Good:
-- Use structured, procedural, reliable phrasing.
-- Focus on timing, clarity, and learner safety.
-- Prefer verbs such as ensure, maintain, provide, follow up.
-
-When Target Rating is Outstanding:
-- Use ambitious, creative phrasing showing learner autonomy.
-- Prefer verbs such as inspire, facilitate, empower, extend.
-
-Required output structure
-SECTION 1 — Complete Lesson Plan
-1. Lesson Information
-   Teacher, Lesson No., Duration, Level, Lesson Type, Learner Profile, Anticipated Problems
-
-2. Learning Objectives
-   - Write 2–3 measurable objectives beginning with Students will be able to …
-   - Link each to Bloom’s levels Understand, Apply, Analyze, Create.
-   - Align objectives to rubric expectations.
-
-3. Target Language
-   Two-column table:
-   Component | Content
-   Grammar / Structure |
-   Vocabulary |
-   Pronunciation Focus |
-   Functional Language |
-
-4. Lesson Stages
-   Six-column table:
-   Stage | Timing | Purpose / Description | Teacher’s Role | Learners’ Role | Interaction Pattern
-   Ensure interaction patterns include T→S, S↔S, Pair Work, Group Work, Whole Class.
-
-   After the table, include a Supporting Details paragraph for each major stage covering actions, examples, aids, formative checks, transitions, differentiation, and observable behaviours.
-
-5. Differentiation
-6. Assessment and Feedback
-7. Reflection and Notes
-
-SECTION 2 — Observation Readiness Coaching Guide
-For each of the eleven rubric items above:
-- Domain Name
-- Rubric Check: State explicitly how this plan meets the Good or Outstanding descriptor using the exact descriptor wording where appropriate.
-- AI Mentor Comment: Provide one practical improvement or reflection point.
-
-Rubric self-check before output
-1. All rubric items covered.
-2. Descriptor alignment matches the chosen Target Rating and uses the exact phrasing provided above.
-3. All required headings and sub-sections exist.
-4. Lesson Stages include Supporting Details paragraphs.
-5. No Summary lines are present.
-6. Output is structured, professional, and plain-text.
-"""
-
-# ------------------------------------------------------------
-# FILE TEXT EXTRACTION (PDF ONLY)
-# ------------------------------------------------------------
-def extract_text_from_file(file):
-    name = file.filename.lower()
-    if not name.endswith(".pdf"):
-        return ""
-    reader = PdfReader(file)
-    text = "\n".join([(page.extract_text() or "") for page in reader.pages])
-    return text.strip()
-
-# ------------------------------------------------------------
-# MAIN ROUTE
-# ------------------------------------------------------------
-@app.route("/generate", methods=["POST"])
-def generate_lesson_plan():
-    try:
-        file = request.files.get("file")
-        if not file:
-            return jsonify({"error": "No file uploaded"}), 400
-
-        text_content = extract_text_from_file(file)
-        if not text_content:
-            return jsonify({"error": "Could not extract text from PDF"}), 400
-
-        teacher_name = request.form.get("teacher_name", "N/A")
-        lesson_number = request.form.get("lesson_number", "N/A")
-        lesson_duration = request.form.get("lesson_duration", "N/A")
-        learner_profile = request.form.get("learner_profile", "N/A")
-        anticipated_problems = request.form.get("anticipated_problems", "N/A")
-        target_rating = request.form.get("target_rating", "Good")
-
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
-
-        user_prompt = f"""
-Teacher Name: {teacher_name}
-Lesson Number: {lesson_number}
-Lesson Duration: {lesson_duration}
-Learner Profile: {learner_profile}
-Anticipated Problems: {anticipated_problems}
-Target Rating: {target_rating}
-Timestamp: {timestamp}
-
-Extracted Lesson Content:
-{text_content}
-"""
-
-        # ---------------- AI CALL ----------------
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": user_prompt},
-            ],
-            temperature=0.4,
-        )
-
-        lesson_text = response.choices[0].message.content or ""
-        # Hard rule: strip any asterisks if the model ever emits them
-        lesson_text = lesson_text.replace("*", "")
-
-        # ---------------- CLEANUP ----------------
-        lesson_text = re.sub(r"(?i)^.*summary of ai[- ]?generated guidance.*$", "", lesson_text, flags=re.MULTILINE)
-        lesson_text = re.sub(r"\n{3,}", "\n\n", lesson_text).strip()
-
-        # ---------------- DOCX GENERATION ----------------
-        doc = Document()
-        section = doc.sections[0]
-        section.orientation = WD_ORIENT.LANDSCAPE
-        section.page_width, section.page_height = section.page_height, section.page_width
-        section.left_margin = Inches(0.7)
-        section.right_margin = Inches(0.7)
-        section.top_margin = Inches(0.6)
-        section.bottom_margin = Inches(0.6)
-
-        style = doc.styles["Normal"]
-        style.font.name = "Calibri"
-        style.font.size = Pt(11)
-
-        doc.add_heading("AI Lesson Plan — Observation Readiness Coach", level=0)
-        doc.add_paragraph(f"Generated on: {timestamp}")
-        doc.add_paragraph(f"Target Rating: {target_rating}")
-        doc.add_paragraph("")
-
-        current_table = None
-        current_table_cols = 0
-        inside_section2 = False
-        in_supporting_details = False
-
-        # Helper: finalize any open table before inserting non-table content
-        def close_table():
-            nonlocal current_table, current_table_cols
-            current_table = None
-            current_table_cols = 0
-
-        # Recognized block headings
-        HEADING_KEYS = [
-            "lesson information", "learning objectives", "target language",
-            "lesson stages", "supporting details", "differentiation",
-            "assessment and feedback", "assessment & feedback",
-            "reflection and notes", "reflection & notes"
-        ]
-
-        # Label pattern for bulletizing supporting details
-        LABEL_RE = re.compile(r"^([A-Z][A-Za-z &]+):\s*(.*)$")
-
-        for raw in lesson_text.split("\n"):
-            line = raw.strip()
-            if not line:
-                # Blank line ends supporting-details bullet mode
-                if in_supporting_details:
-                    in_supporting_details = False
-                continue
-
-            # SECTION 2 page break
-            if "SECTION 2" in line.upper() and not inside_section2:
-                close_table()
-                doc.add_page_break()
-                inside_section2 = True
-                in_supporting_details = False
-                continue
-
-            # SECTION headers like "Section 1 — ..." or "SECTION 1 — ..."
-            if re.match(r"^section\s+\d+", line, re.I):
-                close_table()
-                in_supporting_details = False
-                p = doc.add_paragraph(line.upper())
-                run = p.runs[0]
-                run.font.bold = True
-                run.font.size = Pt(14)
-                run.font.color.rgb = RGBColor(255, 255, 255)
-                shading = parse_xml(r'<w:shd {} w:fill="003366"/>'.format(nsdecls("w")))
-                p._p.get_or_add_pPr().append(shading)
-                p.alignment = 1
-                doc.add_paragraph()
-                continue
-
-            # Pipe tables
-            if "|" in line:
-                cols = [c.strip() for c in line.split("|")]
-                if current_table is None:
-                    current_table = doc.add_table(rows=1, cols=len(cols))
-                    current_table_cols = len(cols)
-                    current_table.style = "Table Grid"
-                    hdr_cells = current_table.rows[0].cells
-                    for i, text in enumerate(cols):
-                        hdr_cells[i].text = text
-                        for pp in hdr_cells[i].paragraphs:
-                            rr = pp.runs[0] if pp.runs else pp.add_run()
-                            rr.font.bold = True
-                            rr.font.size = Pt(10)
-                    for cell in hdr_cells:
-                        shading = parse_xml(r'<w:shd {} w:fill="E6E6FA"/>'.format(nsdecls("w")))
-                        cell._tc.get_or_add_tcPr().append(shading)
-                else:
-                    if len(cols) < current_table_cols:
-                        cols += [""] * (current_table_cols - len(cols))
-                    elif len(cols) > current_table_cols:
-                        cols = cols[:current_table_cols]
-                    row = current_table.add_row()
-                    for i, text in enumerate(cols):
-                        row.cells[i].text = text
-                continue
-
-            # Domain table blocks in Section 2
-            low = line.lower()
-            if low.startswith("domain name"):
-                close_table()
-                in_supporting_details = False
-                current_table = doc.add_table(rows=3, cols=2)
-                current_table_cols = 2
-                current_table.style = "Table Grid"
-                for column in current_table.columns:
-                    for cell in column.cells:
-                        cell.width = Inches(3.5)
-                hdr = current_table.rows[0].cells
-                hdr[0].text = "Domain Name"
-                hdr[1].text = re.sub(r"^domain name[:]*", "", line, flags=re.I).strip()
-                hdr[0].paragraphs[0].runs[0].font.bold = True
-                hdr[0]._tc.get_or_add_tcPr().append(parse_xml(r'<w:shd {} w:fill="D9D9D9"/>'.format(nsdecls("w"))))
-                continue
-
-            if low.startswith("rubric check"):
-                if current_table is not None and len(current_table.rows) >= 2:
-                    row = current_table.rows[1]
-                    row.cells[0].text = "Rubric Check"
-                    row.cells[1].text = re.sub(r"^rubric check[:]*", "", line, flags=re.I).strip()
-                    row.cells[0].paragraphs[0].runs[0].font.bold = True
-                continue
-
-            if low.startswith("ai mentor comment"):
-                if current_table is not None and len(current_table.rows) >= 3:
-                    row = current_table.rows[2]
-                    row.cells[0].text = "AI Mentor Comment"
-                    row.cells[1].text = re.sub(r"^ai mentor comment[:]*", "", line, flags=re.I).strip()
-                    row.cells[0].paragraphs[0].runs[0].font.bold = True
-                close_table()
-                continue
-
-            # Headings and heading+content on the same line
-            # Detect any known heading at start, possibly followed by text.
-            matched_heading = None
-            for hk in HEADING_KEYS:
-                if line.lower().startswith(hk):
-                    matched_heading = hk
-                    break
-
-            if matched_heading:
-                close_table()
-                in_supporting_details = ("supporting details" in matched_heading)
-
-                # Split heading from any trailing content on the same line
-                trailing = line[len(matched_heading):].strip(" :—-")
-                # Add heading as bold
-                p = doc.add_paragraph(line[:len(matched_heading)])
-                if p.runs:
-                    p.runs[0].font.bold = True
-                    p.runs[0].font.size = Pt(12)
-                p.paragraph_format.space_before = Pt(8)
-                p.paragraph_format.space_after = Pt(6)
-
-                # If there is trailing content, add it as a normal paragraph (not bold)
-                if trailing:
-                    q = doc.add_paragraph(trailing)
-                    q.paragraph_format.line_spacing = 1.15
-                    q.paragraph_format.space_after = Pt(4)
-
-                continue
-
-            # Bullet list for Supporting Details
-            if in_supporting_details:
-                m = LABEL_RE.match(line)
-                if m:
-                    label, rest = m.group(1), m.group(2)
-                    item = doc.add_paragraph(style=None)
-                    item.style = doc.styles['List Bullet']
-                    run_label = item.add_run(label + ": ")
-                    run_label.font.bold = True
-                    item.add_run(rest)
-                else:
-                    item = doc.add_paragraph(style=None)
-                    item.style = doc.styles['List Bullet']
-                    item.add_run(line)
-                continue
-
-            # Default paragraph
-            close_table()
-            in_supporting_details = False
-            p = doc.add_paragraph(line)
-            p.paragraph_format.line_spacing = 1.15
-            p.paragraph_format.space_after = Pt(4)
-
-        # Footer
-        footer = doc.sections[0].footer
-        footer_para = footer.paragraphs[0]
-        footer_para.text = "AI Lesson Planner — BAE StanEval Hybrid | © 2025 Kaled Alenezi"
-        footer_para.alignment = 1
-        footer_para.runs[0].font.size = Pt(8)
-
-        # Save and return
-        output = tempfile.NamedTemporaryFile(delete=False, suffix=".docx")
-        doc.save(output.name)
-        output.seek(0)
-        return send_file(output.name, as_attachment=True, download_name="BAE_Lesson_Plan.docx")
-
-    except Exception as e:
-        print("❌ ERROR in /generate:", e)
-        return jsonify({"error": str(e)}), 500
-
-
-if __name__ == "__main__":
-    # If deploying on Railway/Gunicorn, this block is ignored (Gunicorn imports the app)
-    app.run(host="0.0.0.0", port=5000)
+import os
+
+# Tesseract's internal OpenMP threading costs more in coordination than
+# it returns; pin each OCR process to one thread (must be set before any
+# tesseract binding loads) and get parallelism from the page-level
+# process pool instead.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+import io
+import re
+import json
+import hashlib
+import asyncio
+import logging
+import logging.handlers
+import queue
+import threading
+import httpx
+from flask import Flask, request, jsonify, send_file
+from flask_cors import CORS
+from werkzeug.exceptions import HTTPException
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from llm_cache import SemanticCache
+from docx_renderer import StreamRenderer, render
+import pymupdf
+import pytesseract
+from PIL import Image
+from openpyxl import load_workbook
+from docx import Document
+from docx.shared import Inches, Pt
+from docx.enum.section import WD_ORIENT
+from docx.oxml.ns import qn
+import tempfile
+import time
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
+
+app = Flask(__name__)
+
+# Bound request bodies before multipart parsing starts: Werkzeug answers
+# oversized uploads with 413 instead of buffering them through the
+# worker. 25 MB comfortably covers any real lesson file.
+app.config["MAX_CONTENT_LENGTH"] = 25 * 1024 * 1024
+
+# ✅ Serialize JSON with orjson (3-5× faster than stdlib json and fewer
+# allocations); fall back silently to Flask's default provider if the
+# wheel is unavailable on the host.
+try:
+    import orjson
+    from flask.json.provider import JSONProvider
+
+    class ORJSONProvider(JSONProvider):
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = ORJSONProvider(app)
+except ImportError:
+    pass
+
+# ✅ Route log records through an in-memory queue so a burst of failures
+# never serializes request threads behind stdout flushes: handlers on
+# the request path only enqueue, and a listener thread drains to the
+# stream Railway scrapes. (A rotating file would be lost on redeploy.)
+_log_queue = queue.Queue(-1)
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+app.logger.handlers = [logging.handlers.QueueHandler(_log_queue)]
+app.logger.setLevel(logging.INFO)
+
+# ✅ CORS scoped to the generate routes only. Wildcard stays the default
+# so existing deploys keep working until FRONTEND_ORIGIN is set; max_age
+# lets browsers cache the preflight for a day instead of re-sending
+# OPTIONS before every request.
+_FRONTEND_ORIGIN = os.getenv("FRONTEND_ORIGIN", "*")
+CORS(app, resources={r"/generate*": {
+    "origins": _FRONTEND_ORIGIN,
+    "methods": ["GET", "POST", "OPTIONS"],
+    "allow_headers": ["Content-Type", "Authorization"],
+    "max_age": 86400,
+}})
+
+
+# ✅ Initialize OpenAI client (async, shared across all requests).
+# An explicit httpx pool raises the default connection limits so bursts
+# of concurrent requests reuse warm TLS connections instead of queueing
+# behind the stock pool or re-handshaking.
+_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=100),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+# max_retries=0: tenacity owns retries on the completion call; letting
+# the SDK also retry internally would multiply attempts (3×3) and stack
+# backoff waits on a flaky network.
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=_http_client, max_retries=0)
+
+# ✅ One long-lived event loop for all OpenAI I/O.
+# Every request hands its coroutine to this loop, so concurrent LLM calls
+# multiplex over a single connection pool instead of blocking workers
+# behind one synchronous HTTP call each.
+_openai_loop = asyncio.new_event_loop()
+threading.Thread(target=_openai_loop.run_forever, name="openai-loop", daemon=True).start()
+
+
+def run_async(coro):
+    """Run a coroutine on the shared OpenAI event loop from sync Flask code."""
+    return asyncio.run_coroutine_threadsafe(coro, _openai_loop).result()
+
+# ------------------------------------------------------------
+# BASIC ROUTES
+# ------------------------------------------------------------
+@app.route("/", methods=["GET"])
+def home():
+    return jsonify({"message": "Lesson Planner API is running"}), 200
+
+# ------------------------------------------------------------
+# SYSTEM PROMPT — EXACT TEXT AND NO ASTERISKS
+# ------------------------------------------------------------
+# Keep this block byte-for-byte stable and always send it as the first
+# message: it is well past OpenAI's 1024-token floor, so the API serves
+# it from its prompt cache (cheaper, faster prefill) as long as no
+# dynamic text is interpolated into it. Per-request fields belong in
+# the user message only.
+SYSTEM_PROMPT = """
+You are an expert English Language Teaching (ELT) mentor and instructional designer
+operating within the BAE Systems KSA Training Standards (StanEval Form 0098).
+
+Your purpose is to generate complete, professional, observation-ready English lesson plans
+and mentoring guidance that fully meet the standards for Good and Outstanding
+teaching performance in accordance with the official BAE StanEval rubric.
+
+Important style rules
+- Plain text only; no markdown or code blocks.
+- Never output asterisks at all. Do not output * or ** anywhere.
+- Use formal, readable English suitable for observation reports.
+- Write headings as plain words only; do not surround with symbols.
+- Include blank lines between sections for clarity.
+- Make the output export-ready for DOCX in landscape orientation.
+
+Context and role
+- Your audience is BAE Systems instructors and cadet-class teachers in KSA.
+- Your tone must be professional, supportive, and rubric-aligned.
+- You prepare teachers for real formal observations; your lesson plans must show clear evidence of meeting each StanEval domain.
+
+Rubric domains and exact performance descriptors
+Use the following descriptors verbatim whenever you reference or check against the rubric. Do not paraphrase or invent new wording. Only the Good and Outstanding levels are permitted.
+
+1) Lesson Plan
+Outstanding: Highly detailed, including full explanation of timed stages, structure, method and interaction patterns. Excellent range of activities planned. Clearly identifies resources to meet learning needs.
+Good: Good, clear structure which identifies resources, and activities linked to learning needs. May lack detail but nevertheless maps defined stages progressively, with approximate timings, throughout the lesson.
+
+2) Introduction, Aims and Objectives
+Outstanding: Comprehensive introduction. Aims and objectives are fully explained, shared and displayed. Learners are able to demonstrate clear understanding of the lesson’s purpose.
+Good: Detailed introduction in which aims and objectives are shared with learners at beginning or as the lesson unfolds. Further explanation of objectives provided. Learners clear about learning purpose.
+
+3) Student and Classroom Management
+Outstanding: Takes responsibility for and has the knowledge to promote and manage behaviour effectively. Actively encourages learners to behave well; manages a high level of motivation. Professional learning environment, fully compliant with Standard Operating Procedures (SOP-4) and mandated classroom protocols.
+Good: Sets, manages and enforces clear rules and routines. Demonstrates a positive relationship with all learners. Exercises authority appropriately. May raise minor concerns. Fit for purpose, well laid out, accessible and safely equipped.
+
+4) Training and Teaching Aids and Resources
+Outstanding: Variety of training/teaching aids used to enhance learning objectives. Training/teaching aids sourced beyond the classroom environment and authorised for use to support continuous improvement. Aids and resources fully integrated into the lesson delivery.
+Good: Training/teaching aids and resources are well-prepared. Usage enhances understanding/delivery of the lesson and assists in achieving the lesson objectives.
+
+5) Communication Skills
+Outstanding: Outstanding presentation skills which engage learners and promote high levels of sustained motivation and concentration. Positive verbal and non-verbal communication, such as strong voice, fluent speech patterns, clear eye contact, enthusiastic manner and open body language/expression.
+Good: Delivery shows a good level of commitment and energy and holds learner’s interest. Good presentation skills which promote motivation and concentration. Teacher demonstrates effective verbal/non-verbal communication skills.
+
+6) Variety and Effectiveness of Interaction
+Outstanding: Wide variety of interaction in the classroom that includes pair and group work. The lesson contains many planned stages of learner-centred activity with the teacher playing a facilitator role. All interaction with learners is effective, has a clear purpose and is handled well.
+Good: Good variety of interaction in the classroom that includes pair and group work. The lesson contains some planned stages of learner-centred activity with the teacher playing a facilitator role. Most of the interaction attempted with learners is effective, has a clear purpose and is handled well.
+
+7) Question and Answer Techniques
+Outstanding: Wide range of questions used. Questions challenge and stimulate learning, encouraging learners to pose questions and responses where appropriate. Checking of understanding is present throughout, enabling continuous assessment of student learning.
+Good: Variety of questioning techniques used effectively, not limited to pose-pause-pounce but includes other techniques such as open and closed questions. Student responses are well managed and encourage further questioning.
+
+8) Check of Learning and Summary
+Outstanding: Comprehensive review of learning progress throughout lesson and clear summary linked to learning aims/objectives. Check for learning is continuous and thorough.
+Good: Clear, concise review/recap at points in the lesson and clear summary of learning progress at end of lesson with links to lesson aims/objectives.
+
+9) Practical Activity — Safety
+Outstanding: A comprehensive safety introduction brief, relevant to task and working environment. Learners are able to demonstrate clear understanding of all safety aspects. Comprehensive explanation of PPE given and supplied where required. Risk assessment available.
+Good: Detailed safety introduction brief, relevant to task and working environment. Learners clear on all safety aspects. PPE explained and supplied where required and further explanation of reason for their use. Risk assessment available.
+
+10) Practical Activity — Explanation of Task
+Outstanding: Comprehensive explanation of task. Learning aims of the task are fully explained and shared. Learners are able to demonstrate clear understanding of what they will be doing and how.
+Good: Detailed explanation of task. Learning aims of the task are detailed in logical steps with the learners clear about what they will be doing and how.
+
+11) Practical Activity — Engagement and Inclusion of Task
+Outstanding: Outstanding level of encouragement given from teacher/instructor, ensuring a high level of engagement and inclusion with the task from learners. All cadets fully engaged; positive learning taking place.
+Good: Good level of encouragement given from teacher/instructor, ensuring a consistent level of engagement and inclusion with the task from learners. All cadets fully engaged; positive learning taking place.
+
+Generation logic
+When Target Rating is Good:
+- Use structured, procedural, reliable phrasing.
+- Focus on timing, clarity, and learner safety.
+- Prefer verbs such as ensure, maintain, provide, follow up.
+
+When Target Rating is Outstanding:
+- Use ambitious, creative phrasing showing learner autonomy.
+- Prefer verbs such as inspire, facilitate, empower, extend.
+
+Required output structure
+SECTION 1 — Complete Lesson Plan
+1. Lesson Information
+   Teacher, Lesson No., Duration, Level, Lesson Type, Learner Profile, Anticipated Problems
+
+2. Learning Objectives
+   - Write 2–3 measurable objectives beginning with Students will be able to …
+   - Link each to Bloom’s levels Understand, Apply, Analyze, Create.
+   - Align objectives to rubric expectations.
+
+3. Target Language
+   Two-column table:
+   Component | Content
+   Grammar / Structure |
+   Vocabulary |
+   Pronunciation Focus |
+   Functional Language |
+
+4. Lesson Stages
+   Six-column table:
+   Stage | Timing | Purpose / Description | Teacher’s Role | Learners’ Role | Interaction Pattern
+   Ensure interaction patterns include T→S, S↔S, Pair Work, Group Work, Whole Class.
+
+   After the table, include a Supporting Details paragraph for each major stage covering actions, examples, aids, formative checks, transitions, differentiation, and observable behaviours.
+
+5. Differentiation
+6. Assessment and Feedback
+7. Reflection and Notes
+
+SECTION 2 — Observation Readiness Coaching Guide
+For each of the eleven rubric items above:
+- Domain Name
+- Rubric Check: State explicitly how this plan meets the Good or Outstanding descriptor using the exact descriptor wording where appropriate.
+- AI Mentor Comment: Provide one practical improvement or reflection point.
+
+Rubric self-check before output
+1. All rubric items covered.
+2. Descriptor alignment matches the chosen Target Rating and uses the exact phrasing provided above.
+3. All required headings and sub-sections exist.
+4. Lesson Stages include Supporting Details paragraphs.
+5. No Summary lines are present.
+6. Output is structured, professional, and plain-text.
+"""
+
+# ------------------------------------------------------------
+# FILE TEXT EXTRACTION (PDF ONLY)
+# ------------------------------------------------------------
+# ✅ OCR engine: tesserocr keeps one Tesseract API (and its language
+# model) resident in the process instead of spawning the tesseract
+# binary per image the way pytesseract does. It needs libtesseract at
+# build time, so fall back to pytesseract where it is not installed.
+try:
+    from tesserocr import PyTessBaseAPI, PSM
+    # Same engine setup as the pytesseract fallback (--psm 6): one
+    # uniform block of text, configured once for the process lifetime.
+    _TESS_API = PyTessBaseAPI(psm=PSM.SINGLE_BLOCK, lang="eng")
+except ImportError:
+    _TESS_API = None
+# The Tesseract API is not thread-safe
+_TESS_LOCK = threading.Lock()
+
+_IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+# LSTM engine only, single uniform block — skips the legacy-engine pass
+_TESS_CONFIG = "--oem 1 --psm 6"
+# Tesseract runtime scales with pixel count; lesson scans are legible
+# well below this edge length.
+_OCR_MAX_EDGE = 2000
+
+
+def _preprocess_for_ocr(img):
+    """Grayscale, cap the size, and binarize so Tesseract does less work."""
+    img = img.convert("L")
+    if max(img.size) > _OCR_MAX_EDGE:
+        img.thumbnail((_OCR_MAX_EDGE, _OCR_MAX_EDGE), Image.LANCZOS)
+    return img.point(lambda p: 255 if p > 180 else 0, mode="1")
+
+
+def _ocr(img):
+    img = _preprocess_for_ocr(img)
+    if _TESS_API is not None:
+        with _TESS_LOCK:
+            _TESS_API.SetImage(img)
+            return _TESS_API.GetUTF8Text()
+    return pytesseract.image_to_string(img, config=_TESS_CONFIG)
+
+
+def _extract_image(data):
+    return _ocr(Image.open(io.BytesIO(data)))
+
+
+# ✅ Extraction cache: identical files are often re-submitted, so the
+# extracted text is kept on disk keyed by a hash of the raw bytes.
+_EXTRACT_CACHE_DIR = Path(tempfile.gettempdir()) / "lp_extract_cache"
+_EXTRACT_CACHE_DIR.mkdir(exist_ok=True)
+_EXTRACT_CACHE_MAX_FILES = 256
+
+
+def _extract_cache_get(digest):
+    path = _EXTRACT_CACHE_DIR / f"{digest}.txt"
+    try:
+        return path.read_text(encoding="utf-8")
+    except OSError:
+        return None
+
+
+def _extract_cache_put(digest, text):
+    path = _EXTRACT_CACHE_DIR / f"{digest}.txt"
+    tmp_path = path.with_suffix(".tmp")
+    try:
+        tmp_path.write_text(text, encoding="utf-8")
+        tmp_path.replace(path)
+        # Crude LRU: when the cache grows past the cap, drop the oldest entries.
+        entries = sorted(_EXTRACT_CACHE_DIR.glob("*.txt"), key=lambda p: p.stat().st_mtime)
+        for stale in entries[:-_EXTRACT_CACHE_MAX_FILES]:
+            stale.unlink(missing_ok=True)
+    except OSError:
+        pass  # caching is best-effort; extraction already succeeded
+
+
+# Below this page count a pool is not worth its start-up cost; PyMuPDF
+# extracts most pages in single-digit milliseconds.
+_PDF_POOL_THRESHOLD = 16
+
+
+# Two-tier extraction: pages with a text layer stay on the millisecond
+# path; pages yielding fewer characters than this are treated as scans
+# and routed through Tesseract.
+_PDF_OCR_MIN_CHARS = 10
+_PDF_OCR_DPI = 200
+
+
+def _extract_pdf_page_text(page):
+    text = page.get_text()
+    if len(text.strip()) >= _PDF_OCR_MIN_CHARS:
+        return text
+    pix = page.get_pixmap(dpi=_PDF_OCR_DPI)
+    img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    return _ocr(img)
+
+
+def _extract_pdf_page(pdf_bytes, page_index):
+    """Worker: re-open the PDF from raw bytes and extract a single page."""
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as pdf:
+        return _extract_pdf_page_text(pdf[page_index])
+
+
+def _ocr_pdf_page(pdf_bytes, page_index):
+    """Worker: rasterize one PDF page and OCR it."""
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as pdf:
+        pix = pdf[page_index].get_pixmap(dpi=_PDF_OCR_DPI)
+    return _ocr(Image.frombytes("RGB", (pix.width, pix.height), pix.samples))
+
+
+def _extract_pdf(pdf_bytes):
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as pdf:
+        num_pages = len(pdf)
+        if num_pages >= _PDF_POOL_THRESHOLD:
+            workers = min(num_pages, os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pages = executor.map(partial(_extract_pdf_page, pdf_bytes), range(num_pages))
+                return "\n".join(pages)
+        texts = [page.get_text() for page in pdf]
+
+    ocr_needed = [i for i, t in enumerate(texts) if len(t.strip()) < _PDF_OCR_MIN_CHARS]
+    if len(ocr_needed) == 1:
+        # A lone scanned page isn't worth pool start-up
+        texts[ocr_needed[0]] = _ocr_pdf_page(pdf_bytes, ocr_needed[0])
+    elif ocr_needed:
+        # With OMP_THREAD_LIMIT=1 each Tesseract process is single-
+        # threaded, so one worker per core is the right pool size.
+        workers = min(len(ocr_needed), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            ocr_texts = executor.map(partial(_ocr_pdf_page, pdf_bytes), ocr_needed)
+            for i, t in zip(ocr_needed, ocr_texts):
+                texts[i] = t
+    return "\n".join(texts)
+
+
+def _extract_docx(data):
+    # Walk the <w:t> text nodes straight off the lxml body — python-docx's
+    # paragraphs API would wrap every paragraph and run in Python objects
+    # just to read their text.
+    doc = Document(io.BytesIO(data))
+    lines = []
+    for p in doc.element.body.iter(qn("w:p")):
+        text = "".join(t.text for t in p.iter(qn("w:t")) if t.text)
+        if text:
+            lines.append(text)
+    return "\n".join(lines)
+
+
+def _extract_xlsx(data):
+    # read_only streams rows instead of building the whole workbook model;
+    # lines are accumulated in a list and joined once (O(n), not O(n²)).
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        lines = []
+        for sheet in wb.worksheets:
+            for row in sheet.iter_rows(values_only=True):
+                line = " ".join(str(c) for c in row if c is not None)
+                if line:
+                    lines.append(line)
+        return "\n".join(lines)
+    finally:
+        wb.close()
+
+
+def _sniff_format(data, name):
+    """Classify the upload by its magic bytes (extensions lie).
+
+    Zip containers (xlsx/docx) share the PK header, so the extension
+    only breaks that tie.
+    """
+    head = data[:8]
+    if head.startswith(b"%PDF"):
+        return "pdf"
+    if head.startswith(b"PK"):
+        if name.endswith(".xlsx"):
+            return "xlsx"
+        if name.endswith(".docx"):
+            return "docx"
+        return None
+    if head.startswith((b"\x89PNG", b"\xff\xd8")):
+        return "image"
+    return None
+
+
+def extract_text_from_file(file):
+    return _extract_text(file.read(), file.filename.lower())
+
+
+def _extract_text(data, name):
+    if not data:
+        return ""
+    fmt = _sniff_format(data, name)
+    if fmt is None:
+        return ""
+    # blake2b is faster than md5/sha for this job and collision-safe enough
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    cached = _extract_cache_get(digest)
+    if cached is not None:
+        return cached
+    if fmt == "pdf":
+        text = _extract_pdf(data).strip()
+    elif fmt == "xlsx":
+        text = _extract_xlsx(data).strip()
+    elif fmt == "docx":
+        text = _extract_docx(data).strip()
+    else:
+        text = _extract_image(data).strip()
+    _extract_cache_put(digest, text)
+    return text
+
+# ------------------------------------------------------------
+# PROMPT BUILDING
+# ------------------------------------------------------------
+# Cap on extracted-text tokens: prefill time and cost grow linearly with
+# the prompt, and an unbounded 50-page PDF can blow the context window.
+_MAX_CONTENT_TOKENS = 12000
+_APPROX_CHARS_PER_TOKEN = 4
+
+# tiktoken fetches its encoding file on first use; fall back to a
+# character budget if that fails (offline build, unknown model).
+try:
+    import tiktoken
+    _TOKEN_ENCODER = tiktoken.encoding_for_model("gpt-4o-mini")
+except Exception:
+    _TOKEN_ENCODER = None
+
+
+_TRUNCATION_MARKER = "\n...[content truncated]...\n"
+
+
+def truncate_to_token_budget(text):
+    """Clamp extracted text to the model budget before it enters the prompt.
+
+    Over-budget documents keep their head and tail and drop the middle:
+    lesson materials front-load objectives and close with assessment notes,
+    so both ends carry more signal than the body.
+    """
+    if _TOKEN_ENCODER is not None:
+        tokens = _TOKEN_ENCODER.encode(text)
+        if len(tokens) <= _MAX_CONTENT_TOKENS:
+            return text
+        app.logger.info("truncating extracted text: %d tokens over the %d budget",
+                        len(tokens), _MAX_CONTENT_TOKENS)
+        half = _MAX_CONTENT_TOKENS // 2
+        return (_TOKEN_ENCODER.decode(tokens[:half])
+                + _TRUNCATION_MARKER
+                + _TOKEN_ENCODER.decode(tokens[-half:]))
+    limit = _MAX_CONTENT_TOKENS * _APPROX_CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    app.logger.info("truncating extracted text: %d chars over the %d budget",
+                    len(text), limit)
+    half = limit // 2
+    return text[:half] + _TRUNCATION_MARKER + text[-half:]
+
+
+def _format_timestamp():
+    # time.strftime skips datetime's tz-aware object construction; the
+    # output only needs minute precision anyway.
+    return time.strftime("%Y-%m-%d %H:%M")
+
+
+# Static continuation of the cacheable prompt prefix: these instructions
+# never change, so they ride in their own user message between the
+# system prompt and the dynamic block.
+STATIC_USER_TEMPLATE = (
+    "Apply the standards above to the submission that follows. "
+    "It lists the teacher details first, then the extracted lesson content, "
+    "then the generation timestamp. Respect the Target Rating it specifies."
+)
+
+
+def build_user_prompt(form, text_content, timestamp):
+    """Compose the per-lesson dynamic block from the submitted form fields.
+
+    The timestamp goes last: a re-submitted file then shares its entire
+    prompt prefix with the previous run, which is what OpenAI's prefix
+    cache matches on.
+    """
+    return f"""
+Teacher Name: {form.get("teacher_name", "N/A")}
+Lesson Number: {form.get("lesson_number", "N/A")}
+Lesson Duration: {form.get("lesson_duration", "N/A")}
+Learner Profile: {form.get("learner_profile", "N/A")}
+Anticipated Problems: {form.get("anticipated_problems", "N/A")}
+Target Rating: {form.get("target_rating", "Good")}
+
+Extracted Lesson Content:
+{truncate_to_token_budget(text_content)}
+
+Timestamp: {timestamp}
+"""
+
+
+# The first two messages never change; share one dict each across all
+# requests instead of reallocating them per call. The API layer only
+# reads them, so sharing is safe.
+_SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+_STATIC_USER_MESSAGE = {"role": "user", "content": STATIC_USER_TEMPLATE}
+
+
+def build_messages(user_prompt):
+    return [_SYSTEM_MESSAGE, _STATIC_USER_MESSAGE, {"role": "user", "content": user_prompt}]
+
+
+# Retry only the LLM call on transient API failures (429s, timeouts,
+# dropped connections) so a blip doesn't throw away the finished
+# extraction and force the teacher to re-upload.
+_llm_retry = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=2, max=20),
+    retry=retry_if_exception_type(
+        (RateLimitError, APITimeoutError, APIConnectionError, APIStatusError)
+    ),
+    reraise=True,
+)
+
+
+class _LineSink:
+    """Hands completed lesson lines from the stream to the render thread.
+
+    If a retry fires after lines were already emitted, the sink is marked
+    poisoned: the re-streamed attempt may not reproduce the earlier lines,
+    so the consumer must discard what it built and render from the final
+    text instead.
+    """
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.emitted = False
+        self.poisoned = False
+
+    def put(self, line):
+        self.emitted = True
+        self.queue.put(line)
+
+    def finish(self):
+        self.queue.put(None)
+
+
+@_llm_retry
+async def stream_completion(messages, line_sink=None):
+    """Stream a chat completion and return the assembled text.
+
+    Streaming means tokens start flowing as soon as the model produces
+    them instead of waiting for the full completion server-side; with a
+    `line_sink`, completed lines are handed off as they arrive so the
+    DOCX build overlaps the token stream.
+    """
+    if line_sink is not None and line_sink.emitted:
+        # Retry after partial emission — stop streaming into the sink.
+        line_sink.poisoned = True
+        line_sink = None
+    parts = []
+    usage = None
+    pending = ""
+    stream = await client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=messages,
+        temperature=0.4,
+        top_p=1.0,
+        # Decode time and cost scale with output tokens; a full two-section
+        # plan fits comfortably in this cap, which stops runaway completions.
+        max_tokens=4096,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            delta = chunk.choices[0].delta.content
+            parts.append(delta)
+            if line_sink is not None:
+                pending += delta
+                while "\n" in pending:
+                    line, pending = pending.split("\n", 1)
+                    line_sink.put(_clean_lesson_line(line))
+        if chunk.usage:
+            usage = chunk.usage
+    if line_sink is not None and pending:
+        line_sink.put(_clean_lesson_line(pending))
+    if usage and usage.prompt_tokens_details:
+        # Visibility into OpenAI prompt-cache hits on the static prefix
+        app.logger.info(
+            "prompt tokens: %s (cached: %s)",
+            usage.prompt_tokens,
+            usage.prompt_tokens_details.cached_tokens,
+        )
+    return "".join(parts)
+
+
+# ✅ LLM response cache: exact-match fast path plus embedding-similarity
+# fallback, so identical or lightly edited re-submissions skip the
+# completion entirely.
+_llm_cache = SemanticCache(
+    similarity_threshold=0.92,
+    cache_dir=Path(tempfile.gettempdir()) / "lp_llm_cache",
+)
+
+
+async def generate_lesson_text(user_prompt, line_sink=None):
+    """Return the lesson text for a prompt, via cache when possible.
+
+    With a `line_sink`, completion lines are pushed as they stream in;
+    cache hits bypass the sink (the caller renders the returned text).
+    The sink always receives its end-of-stream sentinel, even on error.
+    """
+    try:
+        key = SemanticCache.exact_key("gpt-4o-mini", 0.4, SYSTEM_PROMPT, user_prompt)
+        cached = _llm_cache.get_exact(key)
+        if cached is not None:
+            return cached
+
+        embedding = None
+        try:
+            emb = await client.embeddings.create(
+                model="text-embedding-3-small", input=user_prompt[:8000]
+            )
+            embedding = emb.data[0].embedding
+            similar = _llm_cache.get_semantic(embedding)
+            if similar is not None:
+                return similar
+        except Exception:
+            pass  # the embedding tier is best-effort; fall through to the LLM
+
+        lesson_text = await stream_completion(build_messages(user_prompt), line_sink)
+        _llm_cache.put(key, embedding, lesson_text)
+        return lesson_text
+    finally:
+        if line_sink is not None:
+            line_sink.finish()
+
+
+# ------------------------------------------------------------
+# DOCX TEMPLATE — built once, reopened from bytes per request
+# ------------------------------------------------------------
+def _build_template_bytes():
+    """Construct the static document skeleton (orientation, margins,
+    base style, title and footer) and serialize it once; requests only
+    fill in dynamic content."""
+    doc = Document()
+    section = doc.sections[0]
+    section.orientation = WD_ORIENT.LANDSCAPE
+    section.page_width, section.page_height = section.page_height, section.page_width
+    section.left_margin = Inches(0.7)
+    section.right_margin = Inches(0.7)
+    section.top_margin = Inches(0.6)
+    section.bottom_margin = Inches(0.6)
+
+    style = doc.styles["Normal"]
+    style.font.name = "Calibri"
+    style.font.size = Pt(11)
+
+    doc.add_heading("AI Lesson Plan — Observation Readiness Coach", level=0)
+
+    footer_para = doc.sections[0].footer.paragraphs[0]
+    footer_para.text = "AI Lesson Planner — BAE StanEval Hybrid | © 2025 Kaled Alenezi"
+    footer_para.alignment = 1
+    footer_para.runs[0].font.size = Pt(8)
+
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
+_TEMPLATE_BYTES = _build_template_bytes()
+
+
+# ------------------------------------------------------------
+# BATCH GENERATION (OpenAI Batch API)
+# ------------------------------------------------------------
+# In-memory registry of submitted batch jobs (cleared on restart; the
+# frontend polls by id, so OpenAI remains the source of truth).
+_batch_jobs = {}
+
+
+@app.route("/generate_batch", methods=["POST"])
+def generate_batch():
+    """Package several uploads into one OpenAI Batch job and return its id.
+
+    Trades interactive latency for throughput: all lesson plans are
+    generated server-side by OpenAI in a single batch at discounted cost,
+    and the frontend polls /generate_batch/<id> until completion.
+    """
+    try:
+        files = request.files.getlist("files") or request.files.getlist("file")
+        if not files:
+            return jsonify({"error": "No files uploaded"}), 400
+
+        timestamp = _format_timestamp()
+        lines = []
+        skipped = []
+        for idx, upload in enumerate(files):
+            text_content = extract_text_from_file(upload)
+            if not text_content:
+                skipped.append(upload.filename)
+                continue
+            user_prompt = build_user_prompt(request.form, text_content, timestamp)
+            lines.append(json.dumps({
+                "custom_id": f"lesson-{idx}-{upload.filename}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": "gpt-4o-mini",
+                    "messages": build_messages(user_prompt),
+                    "temperature": 0.4,
+                    "max_tokens": 4096,
+                },
+            }))
+
+        if not lines:
+            return jsonify({"error": "Could not extract text from any file"}), 400
+
+        batch_input = io.BytesIO("\n".join(lines).encode("utf-8"))
+        batch_input.name = "lesson_batch.jsonl"
+        uploaded = run_async(client.files.create(file=batch_input, purpose="batch"))
+        batch = run_async(client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        ))
+        _batch_jobs[batch.id] = {"submitted": timestamp, "files": len(lines)}
+
+        return jsonify({"batch_id": batch.id, "status": batch.status, "skipped": skipped}), 202
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        app.logger.exception("generate_batch failed")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/generate_batch/<batch_id>", methods=["GET"])
+def generate_batch_status(batch_id):
+    """Poll a batch job; stream back the raw results once completed."""
+    try:
+        batch = run_async(client.batches.retrieve(batch_id))
+        if batch.status != "completed":
+            return jsonify({"batch_id": batch.id, "status": batch.status}), 202
+
+        output = run_async(client.files.content(batch.output_file_id))
+        return send_file(
+            io.BytesIO(output.read()),
+            as_attachment=True,
+            download_name=f"{batch_id}_results.jsonl",
+            mimetype="application/jsonl",
+        )
+
+    except Exception as e:
+        app.logger.exception("generate_batch status failed")
+        return jsonify({"error": str(e)}), 500
+
+
+# ------------------------------------------------------------
+# POST-LLM CLEANUP PATTERNS
+# ------------------------------------------------------------
+_SUMMARY_RE = re.compile(r"(?im)^.*summary of ai[- ]?generated guidance.*$")
+_BLANKS_RE = re.compile(r"\n{3,}")
+
+
+def _clean_lesson_line(line):
+    """Per-line version of the post-LLM cleanup, for the streaming path."""
+    line = line.replace("*", "")
+    return "" if _SUMMARY_RE.match(line) else line
+
+
+def _clean_lesson_text(lesson_text):
+    """Whole-text cleanup: strip asterisks, drop the summary banner,
+    collapse blank runs."""
+    lesson_text = lesson_text.replace("*", "")
+    lesson_text = _SUMMARY_RE.sub("", lesson_text)
+    return _BLANKS_RE.sub("\n\n", lesson_text).strip()
+
+
+# ------------------------------------------------------------
+# WHOLE-RESULT CACHE
+# ------------------------------------------------------------
+# Keyed on the raw upload bytes plus the form fields: a re-submitted file
+# with unchanged settings skips extraction, the LLM call and rendering in
+# one hash lookup. TTL-bounded so a repeat a day later still regenerates.
+_RESULT_CACHE_DIR = Path(tempfile.gettempdir()) / "lp_result_cache"
+_RESULT_CACHE_DIR.mkdir(exist_ok=True)
+_RESULT_CACHE_MAX_FILES = 64
+_RESULT_CACHE_TTL = 86400
+
+
+def _result_cache_key(form, data):
+    h = hashlib.sha256(data)
+    for key, value in sorted(form.items()):
+        if key == "mode":  # delivery mode doesn't change the document
+            continue
+        h.update(f"{key}={value}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _result_cache_get(key):
+    path = _RESULT_CACHE_DIR / f"{key}.docx"
+    try:
+        if time.time() - path.stat().st_mtime > _RESULT_CACHE_TTL:
+            path.unlink(missing_ok=True)
+            return None
+        return path.read_bytes()
+    except OSError:
+        return None
+
+
+def _result_cache_put(key, docx_bytes):
+    path = _RESULT_CACHE_DIR / f"{key}.docx"
+    tmp_path = path.with_suffix(".tmp")
+    try:
+        tmp_path.write_bytes(docx_bytes)
+        tmp_path.replace(path)
+        entries = sorted(_RESULT_CACHE_DIR.glob("*.docx"), key=lambda p: p.stat().st_mtime)
+        for stale in entries[:-_RESULT_CACHE_MAX_FILES]:
+            stale.unlink(missing_ok=True)
+    except OSError:
+        pass  # best-effort; the document was generated either way
+
+
+# ------------------------------------------------------------
+# MAIN PIPELINE (no request context — callable from jobs too)
+# ------------------------------------------------------------
+def _generate_lesson_text_only(form, data, filename):
+    """Extraction + LLM with no document build, for format=json callers.
+
+    Returns (lesson_text, timestamp); raises ValueError like the DOCX path.
+    """
+    extract_future = asyncio.run_coroutine_threadsafe(
+        asyncio.to_thread(_extract_text, data, filename.lower()), _openai_loop
+    )
+    timestamp = _format_timestamp()
+    text_content = extract_future.result()
+    if not text_content:
+        raise ValueError("Could not extract text from file")
+
+    user_prompt = build_user_prompt(form, text_content, timestamp)
+    lesson_text = asyncio.run_coroutine_threadsafe(
+        generate_lesson_text(user_prompt), _openai_loop
+    ).result()
+    return _clean_lesson_text(lesson_text), timestamp
+
+
+def _generate_docx_bytes(form, data, filename):
+    """Run extraction → LLM → DOCX for one upload and return the bytes.
+
+    Raises ValueError when no text can be extracted.
+    """
+    # Whole-result short-circuit: same bytes + same settings means the
+    # same document, without touching extraction or the LLM.
+    result_key = _result_cache_key(form, data)
+    cached = _result_cache_get(result_key)
+    if cached is not None:
+        return cached
+
+    # Kick extraction off on the shared loop right away so the form
+    # parsing and prompt scaffolding below overlap with it instead of
+    # waiting for parsing to finish first.
+    extract_future = asyncio.run_coroutine_threadsafe(
+        asyncio.to_thread(_extract_text, data, filename.lower()), _openai_loop
+    )
+
+    target_rating = form.get("target_rating", "Good")
+
+    timestamp = _format_timestamp()
+
+    text_content = extract_future.result()
+    if not text_content:
+        raise ValueError("Could not extract text from file")
+
+    user_prompt = build_user_prompt(form, text_content, timestamp)
+
+    # ---------------- AI CALL + DOCX GENERATION ----------------
+    # The completion streams lines through the sink while this thread
+    # renders them, so parsing/building hides under token arrival. The
+    # landscape skeleton (margins, styles, title, footer) is prebuilt at
+    # import time; only dynamic content is added here.
+    sink = _LineSink()
+    llm_future = asyncio.run_coroutine_threadsafe(
+        generate_lesson_text(user_prompt, sink), _openai_loop
+    )
+
+    def _new_doc():
+        d = Document(io.BytesIO(_TEMPLATE_BYTES))
+        d.add_paragraph(f"Generated on: {timestamp}")
+        d.add_paragraph(f"Target Rating: {target_rating}")
+        d.add_paragraph("")
+        return d
+
+    doc = _new_doc()
+    renderer = StreamRenderer(doc)
+    while True:
+        line = sink.queue.get()
+        if line is None:
+            break
+        renderer.feed(line)
+    renderer.close()
+
+    lesson_text = llm_future.result()  # re-raises any completion error
+
+    if sink.poisoned or not sink.emitted:
+        # Cache hit (nothing streamed) or a retried stream whose early
+        # lines can't be trusted: render the final text from scratch.
+        doc = _new_doc()
+        render(doc, _clean_lesson_text(lesson_text))
+
+    # Serialize to memory — the route (or job) decides how to ship it
+    buf = io.BytesIO()
+    doc.save(buf)
+    docx_bytes = buf.getvalue()
+    _result_cache_put(result_key, docx_bytes)
+    return docx_bytes
+
+
+def _send_docx(docx_bytes):
+    return send_file(
+        io.BytesIO(docx_bytes),
+        as_attachment=True,
+        download_name="BAE_Lesson_Plan.docx",
+        mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    )
+
+
+# ------------------------------------------------------------
+# JOB QUEUE — in-process, polled by id
+# ------------------------------------------------------------
+# A Celery/Redis broker is more than this single-dyno deployment needs;
+# a small thread pool plus an in-memory registry gives the same
+# request/poll shape without new infrastructure.
+_jobs = {}
+_job_executor = ThreadPoolExecutor(max_workers=2)
+
+
+def _run_job(job_id, form, data, filename):
+    try:
+        _jobs[job_id] = {"status": "done", "result": _generate_docx_bytes(form, data, filename)}
+    except Exception as e:
+        _jobs[job_id] = {"status": "error", "error": str(e)}
+
+
+# ------------------------------------------------------------
+# MAIN ROUTE
+# ------------------------------------------------------------
+@app.route("/generate", methods=["POST"])
+def generate_lesson_plan():
+    try:
+        file = request.files.get("file")
+        if not file:
+            return jsonify({"error": "No file uploaded"}), 400
+
+        data = file.read()
+        form = request.form.to_dict()
+
+        # format=json: the caller renders the plan itself, so skip the
+        # whole python-docx build and return the cleaned text.
+        if form.get("format") == "json":
+            lesson_text, timestamp = _generate_lesson_text_only(form, data, file.filename)
+            return jsonify({"lesson_text": lesson_text, "timestamp": timestamp})
+
+        # mode=async: accept the upload, return a job id immediately and
+        # let the frontend poll /generate/jobs/<id> for the document.
+        if form.get("mode") == "async":
+            job_id = uuid.uuid4().hex
+            _jobs[job_id] = {"status": "pending"}
+            _job_executor.submit(_run_job, job_id, form, data, file.filename)
+            return jsonify({"job_id": job_id, "status": "pending"}), 202
+
+        return _send_docx(_generate_docx_bytes(form, data, file.filename))
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except HTTPException:
+        raise  # e.g. 413 from the body-size cap — keep its status code
+    except Exception as e:
+        app.logger.exception("generate_lesson_plan failed")
+        return jsonify({"error": str(e)}), 500
+
+
+# Immediate multi-upload batch: unlike /generate_batch (OpenAI's 24h
+# Batch API), this runs each file through the normal pipeline with
+# bounded parallelism and ships the documents back as one zip. The
+# worker cap keeps a big batch from monopolizing the LLM connection
+# pool; 429s inside each call are handled by the tenacity policy.
+_BATCH_NOW_MAX_FILES = 10
+_BATCH_NOW_WORKERS = 4
+
+
+@app.route("/generate/batch", methods=["POST"])
+def generate_lesson_plans_batch():
+    try:
+        files = request.files.getlist("files") or request.files.getlist("file")
+        if not files:
+            return jsonify({"error": "No files uploaded"}), 400
+        if len(files) > _BATCH_NOW_MAX_FILES:
+            return jsonify({"error": f"Too many files (max {_BATCH_NOW_MAX_FILES})"}), 400
+
+        form = request.form.to_dict()
+        uploads = [(f.filename, f.read()) for f in files]
+
+        with ThreadPoolExecutor(max_workers=min(_BATCH_NOW_WORKERS, len(uploads))) as pool:
+            results = list(pool.map(
+                lambda item: _generate_docx_bytes(form, item[1], item[0]), uploads
+            ))
+
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+            for i, ((name, _), docx_bytes) in enumerate(zip(uploads, results), start=1):
+                stem = os.path.splitext(os.path.basename(name or ""))[0] or f"lesson_{i}"
+                zf.writestr(f"{i:02d}_{stem}_Lesson_Plan.docx", docx_bytes)
+        buf.seek(0)
+        return send_file(buf, as_attachment=True,
+                         download_name="Lesson_Plans.zip", mimetype="application/zip")
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except HTTPException:
+        raise
+    except Exception as e:
+        app.logger.exception("generate batch upload failed")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/generate/jobs/<job_id>", methods=["GET"])
+def generate_job_status(job_id):
+    job = _jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job id"}), 404
+    if job["status"] == "pending":
+        return jsonify({"job_id": job_id, "status": "pending"}), 202
+    if job["status"] == "error":
+        return jsonify({"job_id": job_id, "status": "error", "error": job["error"]}), 500
+    return _send_docx(job["result"])
+
+
+if __name__ == "__main__":
+    # Local development only — production runs under gunicorn (see Procfile),
+    # whose gthread workers let requests overlap during the long OpenAI wait.
+    app.run(host="0.0.0.0", port=5000, debug=False)
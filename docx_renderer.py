@@ -0,0 +1,310 @@
+"""Render cleaned lesson text into a python-docx Document.
+
+The per-line state machine below is the post-LLM hot path, so it lives
+in its own module with full type annotations: `mypyc docx_renderer.py`
+compiles it unchanged for the interpreter-overhead win, and it runs as
+plain Python when no compiled build is present.
+"""
+
+import re
+
+from docx.document import Document
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls, qn
+from docx.shared import Inches, Pt, RGBColor
+
+# Patterns for the per-line loop — compiled once at import
+SECTION_RE = re.compile(r"^section\s+\d+", re.I)
+DOMAIN_NAME_RE = re.compile(r"^domain name[:]*", re.I)
+RUBRIC_CHECK_RE = re.compile(r"^rubric check[:]*", re.I)
+MENTOR_COMMENT_RE = re.compile(r"^ai mentor comment[:]*", re.I)
+
+# Splits a pipe-table row into stripped cells in one pass (the line is
+# already stripped, so only the whitespace around each pipe matters).
+COL_SPLIT_RE = re.compile(r"\s*\|\s*")
+
+# Recognized block headings, as one alternation: a single DFA pass per
+# line replaces the per-key startswith scan, and the second group hands
+# back any trailing content on the heading line for free.
+HEADING_RE = re.compile(
+    r"^(lesson information|learning objectives|target language|"
+    r"lesson stages|supporting details|differentiation|"
+    r"assessment (?:and|&) feedback|reflection (?:and|&) notes)"
+    r"\b[\s:—-]*(.*)$",
+    re.I,
+)
+
+# Label pattern for bulletizing supporting details
+LABEL_RE = re.compile(r"^([A-Z][A-Za-z &]+):\s*(.*)$")
+
+_W_T = qn("w:t")
+
+# Shading XML built once: nsdecls() + str.format were previously run for
+# every shaded cell. parse_xml still runs per use — the returned element
+# is moved into the tree, so a single instance can't be shared.
+_NSDECLS_W = nsdecls("w")
+_SHD_XML_NAVY = r'<w:shd {} w:fill="003366"/>'.format(_NSDECLS_W)
+_SHD_XML_LAVENDER = r'<w:shd {} w:fill="E6E6FA"/>'.format(_NSDECLS_W)
+_SHD_XML_GREY = r'<w:shd {} w:fill="D9D9D9"/>'.format(_NSDECLS_W)
+
+# Shared measurement/colour objects: Pt/Inches/RGBColor each build an
+# EMU value on every call, so the render loop reuses these instead.
+_PT_4 = Pt(4)
+_PT_6 = Pt(6)
+_PT_8 = Pt(8)
+_PT_10 = Pt(10)
+_PT_12 = Pt(12)
+_PT_14 = Pt(14)
+_CELL_WIDTH_DOMAIN = Inches(3.5)
+_WHITE = RGBColor(255, 255, 255)
+
+
+def _fast_set_cell(cell, text: str) -> None:
+    """Write `text` into a table cell, bypassing the `cell.text` setter.
+
+    The setter tears down and rebuilds the cell's paragraph/run tree on
+    every assignment; with the table fills below that adds up to hundreds
+    of re-parses per document. Reuse the first <w:t> when the cell already
+    has one and only fall back to creating a run when it doesn't.
+    """
+    t = cell._tc.find(f".//{_W_T}")
+    if t is None:
+        cell.paragraphs[0].add_run(text)
+    else:
+        t.text = text
+
+
+class StreamRenderer:
+    """Incremental renderer: feed lines as they arrive, close() at the end.
+
+    Holding the state machine in an object (instead of loop locals) lets
+    the caller drive it from a streaming source, so line processing hides
+    under token arrival instead of running after the full completion.
+    Pipe-table rows are buffered until the run ends and the table is then
+    allocated at its final size — one tree allocation instead of an
+    add_row per line. Blank lines never ended a table, so blanks seen
+    mid-buffer only flush if the table doesn't continue past them.
+    """
+
+    def __init__(self, doc: Document) -> None:
+        self.doc = doc
+        self._current_table = None  # open domain-block table
+        self._inside_section2 = False
+        self._in_supporting_details = False
+        self._pending_rows: list[list[str]] = []  # buffered pipe-table run
+        self._pending_blanks = 0
+
+    # -- table handling ------------------------------------------------
+
+    def _close_table(self) -> None:
+        self._current_table = None
+
+    def _flush_pending_table(self) -> None:
+        rows = self._pending_rows
+        if not rows:
+            return
+        self._pending_rows = []
+        doc = self.doc
+        ncols = len(rows[0])
+        table = doc.add_table(rows=len(rows), cols=ncols)
+        table.style = "Table Grid"
+        hdr_cells = table.rows[0].cells
+        for i, text in enumerate(rows[0]):
+            _fast_set_cell(hdr_cells[i], text)
+            for pp in hdr_cells[i].paragraphs:
+                rr = pp.runs[0] if pp.runs else pp.add_run()
+                rr.font.bold = True
+                rr.font.size = _PT_10
+        for cell in hdr_cells:
+            cell._tc.get_or_add_tcPr().append(parse_xml(_SHD_XML_LAVENDER))
+        for j, cols in enumerate(rows[1:], start=1):
+            if len(cols) < ncols:
+                cols += [""] * (ncols - len(cols))
+            elif len(cols) > ncols:
+                cols = cols[:ncols]
+            cells = table.rows[j].cells
+            for i, text in enumerate(cols):
+                _fast_set_cell(cells[i], text)
+
+    # -- tokenization --------------------------------------------------
+
+    def _classify(self, line: str, low: str):
+        """Classify one non-blank line into a (kind, payload) token.
+
+        Each pattern runs at most once per line; the handlers below get
+        the already-extracted payload instead of re-scanning the line.
+        """
+        if "section 2" in low and not self._inside_section2:
+            return "section2", None
+        if SECTION_RE.match(line):
+            return "section", None
+        if "|" in line:
+            return "table_row", COL_SPLIT_RE.split(line)
+        if low.startswith("domain name"):
+            return "domain", DOMAIN_NAME_RE.sub("", line).strip()
+        if low.startswith("rubric check"):
+            return "rubric", RUBRIC_CHECK_RE.sub("", line).strip()
+        if low.startswith("ai mentor comment"):
+            return "mentor", MENTOR_COMMENT_RE.sub("", line).strip()
+        m = HEADING_RE.match(line)
+        if m:
+            return "heading", m
+        return "text", None
+
+    # -- line feed -----------------------------------------------------
+
+    def feed(self, raw: str) -> None:
+        line = raw.strip()
+
+        # While a pipe-table run is buffered, absorb continuations and
+        # interior blanks; anything else flushes the table first.
+        if self._pending_rows:
+            if not line:
+                self._pending_blanks += 1
+                return
+            if "|" in line:
+                self._pending_blanks = 0
+                self._pending_rows.append(COL_SPLIT_RE.split(line))
+                return
+            self._flush_pending_table()
+            if self._pending_blanks:
+                # the swallowed blank(s) would have ended bullet mode
+                self._in_supporting_details = False
+            self._pending_blanks = 0
+
+        if not line:
+            # Blank line ends supporting-details bullet mode
+            if self._in_supporting_details:
+                self._in_supporting_details = False
+            return
+
+        kind, payload = self._classify(line, line.lower())
+        self._HANDLERS[kind](self, line, payload)
+
+    # -- token handlers ------------------------------------------------
+
+    def _on_section2(self, line: str, payload) -> None:
+        # SECTION 2 page break
+        self._close_table()
+        self.doc.add_page_break()
+        self._inside_section2 = True
+        self._in_supporting_details = False
+
+    def _on_section(self, line: str, payload) -> None:
+        # SECTION headers like "Section 1 — ..." or "SECTION 1 — ..."
+        self._close_table()
+        self._in_supporting_details = False
+        doc = self.doc
+        p = doc.add_paragraph(line.upper())
+        run = p.runs[0]
+        run.font.bold = True
+        run.font.size = _PT_14
+        run.font.color.rgb = _WHITE
+        shading = parse_xml(_SHD_XML_NAVY)
+        p._p.get_or_add_pPr().append(shading)
+        p.alignment = 1
+        doc.add_paragraph()
+
+    def _on_table_row(self, line: str, cols: list) -> None:
+        # Pipe tables: start buffering the run
+        self._pending_rows = [cols]
+
+    def _on_domain(self, line: str, value: str) -> None:
+        # Domain table blocks in Section 2
+        self._close_table()
+        self._in_supporting_details = False
+        table = self.doc.add_table(rows=3, cols=2)
+        table.style = "Table Grid"
+        for column in table.columns:
+            for cell in column.cells:
+                cell.width = _CELL_WIDTH_DOMAIN
+        hdr = table.rows[0].cells
+        _fast_set_cell(hdr[0], "Domain Name")
+        _fast_set_cell(hdr[1], value)
+        hdr[0].paragraphs[0].runs[0].font.bold = True
+        hdr[0]._tc.get_or_add_tcPr().append(parse_xml(_SHD_XML_GREY))
+        self._current_table = table
+
+    def _on_rubric(self, line: str, value: str) -> None:
+        table = self._current_table
+        if table is not None and len(table.rows) >= 2:
+            row = table.rows[1]
+            _fast_set_cell(row.cells[0], "Rubric Check")
+            _fast_set_cell(row.cells[1], value)
+            row.cells[0].paragraphs[0].runs[0].font.bold = True
+
+    def _on_mentor(self, line: str, value: str) -> None:
+        table = self._current_table
+        if table is not None and len(table.rows) >= 3:
+            row = table.rows[2]
+            _fast_set_cell(row.cells[0], "AI Mentor Comment")
+            _fast_set_cell(row.cells[1], value)
+            row.cells[0].paragraphs[0].runs[0].font.bold = True
+        self._close_table()
+
+    def _on_heading(self, line: str, m) -> None:
+        # Headings and heading+content on the same line
+        heading = m.group(1)
+        trailing = m.group(2).strip(" :—-")
+        self._close_table()
+        self._in_supporting_details = (heading.lower() == "supporting details")
+
+        doc = self.doc
+        # Add heading as bold, preserving the model's casing
+        p = doc.add_paragraph(heading)
+        if p.runs:
+            p.runs[0].font.bold = True
+            p.runs[0].font.size = _PT_12
+        p.paragraph_format.space_before = _PT_8
+        p.paragraph_format.space_after = _PT_6
+
+        # If there is trailing content, add it as a normal paragraph (not bold)
+        if trailing:
+            q = doc.add_paragraph(trailing)
+            q.paragraph_format.line_spacing = 1.15
+            q.paragraph_format.space_after = _PT_4
+
+    def _on_text(self, line: str, payload) -> None:
+        doc = self.doc
+        # Bullet list for Supporting Details
+        if self._in_supporting_details:
+            m = LABEL_RE.match(line)
+            item = doc.add_paragraph(style=None)
+            item.style = doc.styles['List Bullet']
+            if m:
+                run_label = item.add_run(m.group(1) + ": ")
+                run_label.font.bold = True
+                item.add_run(m.group(2))
+            else:
+                item.add_run(line)
+            return
+
+        # Default paragraph
+        self._close_table()
+        self._in_supporting_details = False
+        p = doc.add_paragraph(line)
+        p.paragraph_format.line_spacing = 1.15
+        p.paragraph_format.space_after = _PT_4
+
+    _HANDLERS = {
+        "section2": _on_section2,
+        "section": _on_section,
+        "table_row": _on_table_row,
+        "domain": _on_domain,
+        "rubric": _on_rubric,
+        "mentor": _on_mentor,
+        "heading": _on_heading,
+        "text": _on_text,
+    }
+
+    def close(self) -> None:
+        """Flush any table run still buffered at end of input."""
+        self._flush_pending_table()
+
+
+def render(doc: Document, lesson_text: str) -> None:
+    """Append the parsed lesson plan to `doc` from complete text."""
+    renderer = StreamRenderer(doc)
+    for raw in lesson_text.split("\n"):
+        renderer.feed(raw)
+    renderer.close()
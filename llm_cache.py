@@ -0,0 +1,109 @@
+"""In-process response cache for OpenAI chat completions.
+
+Two tiers: an exact SHA-256 match on the full prompt for byte-identical
+re-submissions, and a cosine-similarity search over L2-normalized prompt
+embeddings for near-duplicates (same lesson PDF with small edits). A hit
+on either tier skips the entire LLM round trip.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+class SemanticCache:
+    def __init__(self, similarity_threshold=0.92, max_entries=256,
+                 cache_dir=None, ttl=86400):
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        # Optional disk tier for the exact matches: survives worker
+        # restarts/forks, entries expire after `ttl` seconds.
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(exist_ok=True)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # Exact tier: key -> response, with FIFO eviction order.
+        self._exact = {}
+        self._exact_order = []
+        # Semantic tier: embedding matrix rows aligned with responses.
+        # Kept separate from the exact tier because not every entry has
+        # an embedding (the embedding call is best-effort).
+        self._matrix = None  # (n, d) float32, rows L2-normalized
+        self._sem_responses = []
+
+    @staticmethod
+    def exact_key(model, temperature, system_prompt, user_prompt):
+        payload = json.dumps(
+            {"m": model, "t": temperature, "s": system_prompt, "u": user_prompt},
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _normalize(embedding):
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def _disk_get(self, key):
+        if not self.cache_dir:
+            return None
+        path = self.cache_dir / f"{key}.txt"
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                path.unlink(missing_ok=True)
+                return None
+            return path.read_text(encoding="utf-8")
+        except OSError:
+            return None
+
+    def _disk_put(self, key, response):
+        if not self.cache_dir:
+            return
+        path = self.cache_dir / f"{key}.txt"
+        tmp_path = path.with_suffix(".tmp")
+        try:
+            tmp_path.write_text(response, encoding="utf-8")
+            tmp_path.replace(path)
+        except OSError:
+            pass  # best-effort persistence
+
+    def get_exact(self, key):
+        with self._lock:
+            cached = self._exact.get(key)
+        if cached is not None:
+            return cached
+        return self._disk_get(key)
+
+    def get_semantic(self, embedding):
+        """Return the cached response most similar to `embedding`, or None."""
+        vec = self._normalize(embedding)
+        with self._lock:
+            if self._matrix is None or not len(self._matrix):
+                return None
+            sims = self._matrix @ vec
+            best = int(np.argmax(sims))
+            if sims[best] >= self.similarity_threshold:
+                return self._sem_responses[best]
+        return None
+
+    def put(self, key, embedding, response):
+        self._disk_put(key, response)
+        with self._lock:
+            if key not in self._exact:
+                self._exact[key] = response
+                self._exact_order.append(key)
+                if len(self._exact_order) > self.max_entries:
+                    self._exact.pop(self._exact_order.pop(0), None)
+            if embedding is not None:
+                row = self._normalize(embedding)[np.newaxis, :]
+                self._matrix = row if self._matrix is None else np.vstack([self._matrix, row])
+                self._sem_responses.append(response)
+                if len(self._sem_responses) > self.max_entries:
+                    self._matrix = self._matrix[1:]
+                    self._sem_responses.pop(0)